@@ -3,19 +3,31 @@
 import sys
 import os
 import logging
+import mmap
 import subprocess
-from threading import Timer
+import hashlib
 import json
+import operator
 import shutil
 import posixpath
+import random
+import re
+import selectors
+import signal
 import time
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 import calendar
+import datetime
 import tempfile
-import json
 import traceback
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 class TimeoutError(Exception):
@@ -26,45 +38,120 @@ class TimeoutError(Exception):
         return "Executing command '%s' hit timout" % self.cmd
 
 
+class LazyJson(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value)
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mapped:
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mapped)
+        return digest.hexdigest()
+
+
+def filter_filenames(filenames, prefix='', suffix=''):
+    return [filename for filename in filenames if filename.startswith(prefix) and filename.endswith(suffix)]
+
+
+def copy_file(src_path, dest_path, chunk_size=2 ** 30):
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        src_fd = src.fileno()
+        dest_fd = dest.fileno()
+        size = os.fstat(src_fd).st_size
+        os.posix_fadvise(src_fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dest_fd, min(size - offset, chunk_size), offset, offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            pass
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+        while offset < size:
+            copied = os.sendfile(dest_fd, src_fd, offset, min(size - offset, chunk_size))
+            if not copied:
+                break
+            offset += copied
+    shutil.copymode(src_path, dest_path)
+
+
 class LocalStorageBackend(object):
     def __init__(self, root):
         self.root_dir = root
 
     def put_file(self, src_file_path, dest_filename):
-        shutil.copy(src_file_path, os.path.join(self.root_dir, dest_filename))
+        copy_file(src_file_path, os.path.join(self.root_dir, dest_filename))
 
-    def list_files(self):
-        return os.listdir(self.root_dir)
+    def list_files(self, filter_prefix='', filter_suffix=''):
+        with os.scandir(self.root_dir) as entries:
+            return filter_filenames((entry.name for entry in entries), filter_prefix, filter_suffix)
 
     def delete_file(self, filename):
         os.remove(os.path.join(self.root_dir, filename))
 
     def get_file(self, src_filename, dest_file_path):
-        shutil.copy(os.path.join(self.root_dir, src_filename), dest_file_path)
+        copy_file(os.path.join(self.root_dir, src_filename), dest_file_path)
+
+    download_for_verify = get_file
 
 
 class WebdavStorageBackend(object):
     def __init__(self, root, host, login, password):
-        import easywebdav
-        self.root_dir = root
-        protocol, _, host = host.partition('://')
-        self.client = easywebdav.connect(host, username=login, password=password, protocol=protocol)
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.root_dir = posixpath.join('/', root)
+        self.base_url = host.rstrip('/')
+        self.session = requests.Session()
+        self.session.auth = (login, password)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8,
+                              max_retries=Retry(connect=3, read=0, backoff_factor=1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, expected_codes, **kwargs):
+        url = self.base_url + urllib.parse.quote(path)
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code not in expected_codes:
+            raise Exception('Request %s %s returned status %s.\nBODY:\n%s\n' % (
+                method, url, response.status_code, response.text))
+        return response
 
     def put_file(self, src_file_path, dest_filename):
         dest_path = posixpath.join(self.root_dir, dest_filename)
-        self.client.upload(src_file_path, dest_path)
+        with open(src_file_path, 'rb') as f:
+            self._request('PUT', dest_path, (200, 201, 204), data=f)
 
-    def list_files(self):
-        return [urllib.parse.unquote(posixpath.basename(f.name)) for f in self.client.ls(self.root_dir)]
+    def list_files(self, filter_prefix='', filter_suffix=''):
+        response = self._request('PROPFIND', posixpath.join(self.root_dir, ''), (207,), headers={'Depth': '1'})
+        hrefs = ElementTree.fromstring(response.content).findall('{DAV:}response/{DAV:}href')
+        names = [urllib.parse.unquote(posixpath.basename(href.text)) for href in hrefs]
+        return filter_filenames([name for name in names if name], filter_prefix, filter_suffix)
 
     def delete_file(self, filename):
         path = posixpath.join(self.root_dir, filename)
-        self.client.delete(path)
+        self._request('DELETE', path, (200, 204))
 
-    def get_file(self, src_filename, dest_file_path):
+    def download_for_verify(self, src_filename, dest_file_path):
         src_file_path = posixpath.join(self.root_dir, src_filename)
+        with self._request('GET', src_file_path, (200,), stream=True) as response, open(dest_file_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+    def get_file(self, src_filename, dest_file_path):
         tmp_path = dest_file_path + '.tmp'
-        self.client.download(src_file_path, tmp_path)
+        self.download_for_verify(src_filename, tmp_path)
         os.rename(tmp_path, dest_file_path)
 
 
@@ -78,8 +165,9 @@ class ResticStorageBackend(object):
         self.cache_dir = cache_dir
         self.tmp_dir = tmp_dir
         self.rclone_config_file = rclone_config_file
+        self._snapshots = None
         try:
-            self.run_restic('snapshots')
+            self.get_snapshots()
         except:
             self.run_restic('init')
 
@@ -104,27 +192,35 @@ class ResticStorageBackend(object):
                 cmd, p.returncode, stdout, stderr))
         return stdout
 
+    def get_snapshots(self):
+        if self._snapshots is None:
+            self._snapshots = json.loads(self.run_restic('snapshots', ['--no-lock', '--json']))
+        return self._snapshots
+
     def put_file(self, src_file_path, dest_filename):
         with open(src_file_path, 'rb') as f:
             self.run_restic('backup', ['--stdin', '--tag', self.tag_prefix + dest_filename], stdin=f)
+        self._snapshots = None
 
-    def list_files(self):
+    def list_files(self, filter_prefix='', filter_suffix=''):
+        tag_prefix = self.tag_prefix
+        prefix_len = len(tag_prefix)
         names = []
-        for snapshot in json.loads(self.run_restic('snapshots', ['--json'])):
-            for tag in snapshot['tags']:
-                if tag.startswith(self.tag_prefix):
-                    names.append(tag[len(self.tag_prefix):])
-                    break
-            else:
+        for snapshot in self.get_snapshots():
+            name = next((tag[prefix_len:] for tag in snapshot.get('tags', ()) if tag.startswith(tag_prefix)), None)
+            if name is None:
                 raise Exception('Filename tag not found for snapshot %s' % snapshot['short_id'])
-        return names
+            names.append(name)
+        return filter_filenames(names, filter_prefix, filter_suffix)
 
     def delete_file(self, filename):
         raise NotImplementedError
 
     def get_file(self, src_filename, dest_file_path):
         with open(dest_file_path, 'wb') as f:
-            self.run_restic('dump', ['--tag', self.tag_prefix + src_filename, 'latest', 'stdin'], stdout=f)
+            self.run_restic('dump', ['--no-lock', '--tag', self.tag_prefix + src_filename, 'latest', 'stdin'], stdout=f)
+
+    download_for_verify = get_file
 
 
 class RcloneStorageBackend(object):
@@ -152,30 +248,30 @@ class RcloneStorageBackend(object):
         return stdout
 
     def put_file(self, src_file_path, dest_filename):
-        temp_dir = tempfile.mkdtemp()
-        try:
-            shutil.copy(src_file_path, os.path.join(temp_dir, dest_filename))
-            self._run_command(['copy', os.path.join(temp_dir, dest_filename),
-                               self._remote_specifier()])
-        finally:
-            shutil.rmtree(temp_dir)
+        self._run_command(['copyto', src_file_path, self._remote_specifier(dest_filename)])
 
-    def list_files(self):
+    def list_files(self, filter_prefix='', filter_suffix=''):
         s = self._run_command(['lsjson', self._remote_specifier()])
-        return [item['Name'] for item in json.loads(s)]
+        return filter_filenames((item['Name'] for item in json.loads(s)), filter_prefix, filter_suffix)
 
     def delete_file(self, filename):
-        self._run_command(['deletefile', self._remote_specifier(filename)])
+        self.delete_files([filename])
+
+    def delete_files(self, filenames):
+        with tempfile.NamedTemporaryFile('w') as files_list:
+            files_list.write(''.join(filename + '\n' for filename in filenames))
+            files_list.flush()
+            self._run_command(['delete', '--files-from-raw', files_list.name, self._remote_specifier()])
         if self.cleanup_on_delete:
             self._run_command(['cleanup', self._remote_specifier()])
 
+    def download_for_verify(self, src_filename, dest_file_path):
+        self._run_command(['copyto', self._remote_specifier(src_filename), dest_file_path])
+
     def get_file(self, src_filename, dest_file_path):
-        temp_dir = tempfile.mkdtemp()
-        try:
-            self._run_command(['copy', self._remote_specifier(src_filename), temp_dir])
-            shutil.move(os.path.join(temp_dir, src_filename), dest_file_path)
-        finally:
-            shutil.rmtree(temp_dir)
+        tmp_path = dest_file_path + '.tmp'
+        self.download_for_verify(src_filename, tmp_path)
+        os.rename(tmp_path, dest_file_path)
 
 
 storage_classes = {
@@ -188,21 +284,42 @@ storage_classes = {
 
 class BackupApp(object):
     datetime_format = '%Y-%m-%d_%H:%M:%S'
+    datetime_re = r'(\d{4})-(\d{2})-(\d{2})_(\d{2}):(\d{2}):(\d{2})'
+    delete_workers = 8
+    checksum_suffix = '.sha256'
+    script_read_size = 64 * 1024
+    script_output_tail_size = 64 * 1024
 
     def __init__(self, config_filename):
-        self.config = config = yaml.safe_load(open(config_filename))
+        with open(config_filename) as f:
+            self.config = config = yaml.load(f, Loader=YamlLoader)
         self._logger = self.get_logger(config['log_file'], logging.DEBUG)
+        self._filename_template = '%s%s%s' % (
+            config['prefix'].replace('%', '%%'), self.datetime_format, config['suffix'].replace('%', '%%'))
+        self._name_re = re.compile(re.escape(config['prefix']) + self.datetime_re + re.escape(config['suffix']))
+        self.storages = {}
+        self.checksum_file = config['backup_file'] + self.checksum_suffix
+        self._backup_digest = None
 
     def make_backup_filename(self):
-        date_str = time.strftime(self.datetime_format, time.gmtime())
-        return '%s%s%s' % (self.config['prefix'], date_str, self.config['suffix'])
+        return time.strftime(self._filename_template, time.gmtime())
 
     def get_ts_from_backup_name(self, s):
-        date_fmt = '%s%s%s' % (self.config['prefix'], self.datetime_format, self.config['suffix'])
+        m = self._name_re.fullmatch(s)
+        if m is None:
+            return None
+        fields = tuple(map(int, m.groups()))
         try:
-            return calendar.timegm(time.strptime(s, date_fmt))
+            datetime.datetime(*fields[:5])
         except ValueError:
             return None
+        if fields[5] > 61:
+            return None
+        return calendar.timegm(fields)
+
+    def get_backup_dates(self, filenames):
+        return [(filename, file_ts) for filename, file_ts in zip(filenames, map(self.get_ts_from_backup_name, filenames))
+                if file_ts is not None]
 
     def get_storage(self, storage_config):
         storage_config = storage_config.copy()
@@ -211,28 +328,67 @@ class BackupApp(object):
         storage = storage_class(**storage_config)
         return storage
 
-    def upload_backup(self):
-        dest_filename = self.make_backup_filename()
+    def create_storages(self):
+        self.storages = {storage_name: self.get_storage(storage_config)
+                         for storage_name, storage_config in self.config['storages'].items()}
+
+    def run_for_storages(self, func, *args):
         errors = []
-        for storage_name, storage_config in self.config['storages'].items():
-            storage = self.get_storage(storage_config)
-            self.log('INFO', 'uploading', storage=storage_name, filename=dest_filename)
-            try:
-                storage.put_file(src_file_path=self.config['backup_file'], dest_filename=dest_filename)
-            except Exception:
-                errors.append(''.join(traceback.format_exc()))
+        with ThreadPoolExecutor(max_workers=max(len(self.storages), 1)) as pool:
+            futures = [pool.submit(func, storage_name, storage, *args)
+                       for storage_name, storage in self.storages.items()]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    errors.append(''.join(traceback.format_exc()))
         if errors:
             delim = '\n' + '-' * 80 + '\n'
             raise Exception(delim.join(errors))
+
+    def upload_to_storage(self, storage_name, storage, dest_filename, with_checksum):
+        self.log('INFO', 'uploading', storage=storage_name, filename=dest_filename)
+        storage.put_file(src_file_path=self.config['backup_file'], dest_filename=dest_filename)
+        if with_checksum:
+            storage.put_file(src_file_path=self.checksum_file, dest_filename=dest_filename + self.checksum_suffix)
+
+    def upload_backup(self):
+        dest_filename = self.make_backup_filename()
+        with_checksum = bool(self.config.get('verify_one_storage'))
+        if with_checksum:
+            self._backup_digest = file_sha256(self.config['backup_file'])
+            with open(self.checksum_file, 'w') as f:
+                f.write('%s  %s\n' % (self._backup_digest, dest_filename))
+        try:
+            self.run_for_storages(self.upload_to_storage, dest_filename, with_checksum)
+        finally:
+            if with_checksum:
+                os.unlink(self.checksum_file)
         return dest_filename
 
+    def verify_checksum(self, storage_name, storage, filename):
+        self.log('INFO', 'Downloading checksum', storage=storage_name, filename=filename)
+        storage.download_for_verify(filename + self.checksum_suffix, self.checksum_file)
+        with open(self.checksum_file) as f:
+            fields = f.read().split()
+        if not fields or fields[0] != self._backup_digest:
+            self.log('ERROR', 'Checksum mismatch', storage=storage_name, filename=filename)
+            return False
+        return True
+
     def verify_backup(self, filename):
-        for storage_name, storage_config in self.config['storages'].items():
-            storage = self.get_storage(storage_config)
+        full_verify_storages = set(self.storages)
+        if self.config.get('verify_one_storage') and self.storages:
+            full_verify_storages = {random.choice(list(self.storages))}
+        for storage_name, storage in self.storages.items():
             local_file_path = self.config['backup_file']
             self.cleanup()
+            if storage_name not in full_verify_storages:
+                if not self.verify_checksum(storage_name, storage, filename):
+                    return
+                continue
             self.log('INFO', 'Downloading file', storage=storage_name, filename=filename)
-            storage.get_file(filename, local_file_path)
+            storage.download_for_verify(filename, local_file_path)
             try:
                 self.execute_script(self.config['verify'], self.config['verify_timeout'])
             except (TimeoutError, subprocess.CalledProcessError):
@@ -241,59 +397,78 @@ class BackupApp(object):
         with open(self.config['success_timestamp_file'], 'w') as f:
             f.write(str(int(time.time())) + '\n')
 
-    def get_outdated_backup_dates(self, file_ts, retention_config):
+    def make_retention_table(self, retention_config, now):
         if not retention_config:
-            return []
-        outdated = []
-        now = time.time()
+            return ()
+        table = []
         for period in retention_config:
-            period['end'] = now - period['older_days'] * 24 * 3600
-            if 'interval_hours' in period:
-                period['interval'] = period['interval_hours'] * 3600
-        retention_periods = iter(sorted(retention_config, key=lambda rec: rec['end']))
-        current_period = None
-
-        for (filename, ts) in sorted(file_ts, key=lambda fd: fd[1]):
-            while current_period is None or ts > current_period['end']:
-                try:
-                    current_period = next(retention_periods)
-                except StopIteration:
+            end = now - period['older_days'] * 24 * 3600
+            interval = period['interval_hours'] * 3600 if 'interval_hours' in period else None
+            table.append((end, period.get('store', True), interval))
+        return tuple(sorted(table, key=operator.itemgetter(0)))
+
+    def get_outdated_backup_dates(self, file_ts, retention_table):
+        outdated = []
+        retention_periods = iter(retention_table)
+        period_end = None
+
+        for (filename, ts) in sorted(file_ts, key=operator.itemgetter(1)):
+            if period_end is None or ts > period_end:
+                for period_end, period_store, period_interval in retention_periods:
+                    if ts <= period_end:
+                        break
+                else:
                     return outdated
                 current_interval_n = None
-            if not current_period.get('store', True):
+            if not period_store:
                 outdated.append((filename, ts))
                 continue
-            interval_n = int(ts / current_period['interval'])
+            interval_n = ts // period_interval
             if interval_n == current_interval_n:
                 outdated.append((filename, ts))
             else:
                 current_interval_n = interval_n
         return outdated
 
+    def delete_old_backups_from_storage(self, storage_name, storage, retention_tables):
+        suffix = self.config['suffix']
+        filenames = storage.list_files(filter_prefix=self.config['prefix'],
+                                       filter_suffix=(suffix, suffix + self.checksum_suffix))
+        file_dates = self.get_backup_dates(filenames)
+        checksum_names = set(filename for filename in filenames if filename.endswith(self.checksum_suffix))
+
+        outdated_names = []
+        for (filename, _) in self.get_outdated_backup_dates(file_dates, retention_tables[storage_name]):
+            self.log('INFO', 'Remove old file', storage=storage_name, filename=filename)
+            outdated_names.append(filename)
+            if filename + self.checksum_suffix in checksum_names:
+                outdated_names.append(filename + self.checksum_suffix)
+        if not outdated_names:
+            return
+        if hasattr(storage, 'delete_files'):
+            storage.delete_files(outdated_names)
+        else:
+            with ThreadPoolExecutor(max_workers=self.delete_workers) as pool:
+                list(pool.map(storage.delete_file, outdated_names))
+
     def delete_old_backups(self):
+        now = time.time()
+        retention_tables = {}
         for storage_name, storage_config in self.config['storages'].items():
-            storage = self.get_storage(storage_config)
-            filenames = storage.list_files()
-            file_dates = []
-            for filename in filenames:
-                file_ts = self.get_ts_from_backup_name(filename)
-                if file_ts is not None:
-                    file_dates.append((filename, file_ts))
             retention_config = storage_config.get('retention') or self.config.get('retention')
-
-            for (filename, _) in self.get_outdated_backup_dates(file_dates, retention_config):
-                self.log('INFO', 'Remove old file', storage=storage_name, filename=filename)
-                storage.delete_file(filename)
+            retention_tables[storage_name] = self.make_retention_table(retention_config, now)
+        self.run_for_storages(self.delete_old_backups_from_storage, retention_tables)
 
     def cleanup(self):
-        path = self.config['backup_file']
-        if os.path.exists(path):
-            self.log('DEBUG', 'Cleanup', filename=path)
-            os.unlink(self.config['backup_file'])
+        for path in (self.config['backup_file'], self.checksum_file):
+            if os.path.exists(path):
+                self.log('DEBUG', 'Cleanup', filename=path)
+                os.unlink(path)
 
     def run(self):
         try:
             self.log('INFO', 'Started')
+            self.create_storages()
             self.execute_script(self.config['prepare_backup'], self.config['prepare_backup_timeout'])
             filename = self.upload_backup()
             self.delete_old_backups()
@@ -318,29 +493,54 @@ class BackupApp(object):
         return log
 
     def log(self, level, message='', **extra):
+        args = ()
         if extra:
-            message += ' ' + json.dumps(extra)
+            message, args = '%s %s', (message, LazyJson(extra))
         if level == 'EXCEPTION':
-            self._logger.exception(message)
+            self._logger.exception(message, *args)
         else:
-            self._logger.log(getattr(logging, level), message)
+            self._logger.log(getattr(logging, level), message, *args)
 
     def execute_script(self, script, timeout):
         self.log('DEBUG', 'Executing script %r' % script)
-        p = subprocess.Popen(script, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable='/bin/bash')
-        hit_timeout = {'value': False}
-
-        def on_timeout():
-            p.kill()
-            hit_timeout['value'] = True
-
-        timer = Timer(timeout, on_timeout, [])
+        args = ['/bin/bash', '-c', script] if isinstance(script, str) else script
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+                             start_new_session=True)
+        deadline = time.monotonic() + timeout
+        output_tails = {'stdout': bytearray(), 'stderr': bytearray()}
+        selector = selectors.DefaultSelector()
+        selector.register(p.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(p.stderr, selectors.EVENT_READ, 'stderr')
+        hit_timeout = False
         try:
-            timer.start()
-            stdout, stderr = p.communicate()
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(script, timeout)
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, self.script_read_size)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        continue
+                    self.log('DEBUG', 'Script output', stream=key.data, data=chunk.decode(errors='backslashreplace'))
+                    tail = output_tails[key.data]
+                    tail += chunk
+                    del tail[:-self.script_output_tail_size]
+            p.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            p.wait()
+            hit_timeout = True
         finally:
-            timer.cancel()
-        if hit_timeout['value']:
+            selector.close()
+            p.stdout.close()
+            p.stderr.close()
+        stdout = bytes(output_tails['stdout'])
+        stderr = bytes(output_tails['stderr'])
+        if hit_timeout:
             self.log(
                 'ERROR',
                 'Script timeout',
@@ -349,15 +549,9 @@ class BackupApp(object):
                 stderr=stderr.decode(errors='backslashreplace')
             )
             raise TimeoutError(script)
-        self.log(
-            'DEBUG',
-            'Script result',
-            return_cod=p.returncode,
-            stdout=stdout.decode(errors='backslashreplace'),
-            stderr=stderr.decode(errors='backslashreplace')
-        )
+        self.log('DEBUG', 'Script result', return_cod=p.returncode)
         if p.returncode != 0:
-            raise subprocess.CalledProcessError(p.returncode, script)
+            raise subprocess.CalledProcessError(p.returncode, script, output=stdout, stderr=stderr)
 
 
 if __name__ == '__main__':